@@ -6,13 +6,29 @@
 
 import argparse
 import hashlib
+import json
+import mmap
+import os
+import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import requests
 import torch as th
 import tqdm
-from scipy.io import wavfile
+from torch.nn import functional as F
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
 
 from .audio import AudioFile
 from .utils import apply_model, load_model
@@ -31,43 +47,136 @@ PRETRAINED_MODELS = {
     'tasnet_extra.th': '0ccbece3acd98785a367211c9c35b1eadae8d148b0d37fe5a5494d6d335269b5',
 }
 
+# int16 conversion constants used by the hot loops, as plain Python scalars.
+SCALE_I16 = 2**15
+MIN_I16 = -2**15
+MAX_I16 = 2**15 - 1
+INV_SCALE_I16 = 1 / 2**15
+
 
-def download_file(url, target):
+_session = requests.Session()
+
+
+def download_file(url, target, sha256=None):
     """
-    Download a file with a progress bar.
+    Download a file with a progress bar. The data goes to a `.part` file
+    next to `target`, which is renamed to `target` only once it is complete
+    and its digest checked, so `target` never exists in a partial state. If
+    a previous attempt left a `.part` file behind, the download resumes
+    from it with an HTTP range request rather than starting over.
 
     Arguments:
         url (str): url to download
         target (Path): target path to write to
-        sha256 (str or None): expected sha256 hexdigest of the file
+        sha256 (str or None): expected sha256 hexdigest of the file,
+            computed on the fly as bytes are written so the file does not
+            have to be read back for verification.
     """
+    part = target.with_name(target.name + ".part")
+
     def _download():
-        response = requests.get(url, stream=True)
-        total_length = int(response.headers.get('content-length', 0))
+        hasher = hashlib.sha256()
+        existing = part.stat().st_size if part.exists() else 0
+        headers = {}
+        if existing:
+            # Hash the bytes already on disk so a resumed download still
+            # verifies the digest of the complete file.
+            with open(part, "rb") as f:
+                while True:
+                    data = f.read(2**20)
+                    if not data:
+                        break
+                    hasher.update(data)
+            headers["Range"] = f"bytes={existing}-"
+        response = _session.get(url, stream=True, headers=headers)
+        if existing and response.status_code != 206:
+            # The server ignored the range request, start from scratch.
+            existing = 0
+            hasher = hashlib.sha256()
+        total_length = existing + int(response.headers.get('content-length', 0))
 
-        with tqdm.tqdm(total=total_length, ncols=120, unit="B", unit_scale=True) as bar:
-            with open(target, "wb") as output:
-                for data in response.iter_content(chunk_size=4096):
-                    output.write(data)
-                    bar.update(len(data))
+        with tqdm.tqdm(total=total_length, initial=existing,
+                       ncols=120, unit="B", unit_scale=True) as bar:
+            with open(part, "r+b" if part.exists() else "w+b",
+                      buffering=2**20) as output:
+                if total_length > existing:
+                    # Reserve the final size up front so the filesystem can
+                    # allocate one contiguous extent instead of growing the
+                    # file chunk by chunk.
+                    try:
+                        os.posix_fallocate(output.fileno(), existing,
+                                           total_length - existing)
+                    except (AttributeError, OSError):
+                        pass
+                output.seek(existing)
+                try:
+                    for data in response.iter_content(chunk_size=2**20):
+                        output.write(data)
+                        hasher.update(data)
+                        bar.update(len(data))
+                finally:
+                    # Drop whatever tail of the reservation was not filled,
+                    # so a later resume starts from the real download position.
+                    output.truncate()
+        if sha256 is not None and hasher.hexdigest() != sha256:
+            raise ValueError(f"Invalid sha256 signature for the downloaded file {target}. "
+                             f"Expected {sha256} but got {hasher.hexdigest()}.")
+        os.replace(part, target)
 
     try:
         _download()
-    except:  # noqa, re-raising
-        if target.exists():
-            target.unlink()
+    except ValueError:
+        # Corrupted content, a retry would only resume from the same bad bytes.
+        if part.exists():
+            part.unlink()
         raise
 
 
-def verify_file(target, sha256):
+def _hash_range(target, start, size):
     hasher = hashlib.sha256()
     with open(target, "rb") as f:
-        while True:
-            data = f.read(65536)
+        f.seek(start)
+        remaining = size
+        while remaining:
+            data = f.read(min(2**20, remaining))
             if not data:
                 break
             hasher.update(data)
-    signature = hasher.hexdigest()
+            remaining -= len(data)
+    return hasher.digest()
+
+
+def parallel_sha256(target, stripes=4):
+    """
+    Combined digest of `stripes` equal slices of the file: each slice is
+    hashed with SHA-256 in its own thread (hashlib releases the GIL on
+    large updates, so this scales with cores even without hardware SHA
+    instructions), then the slice digests are hashed together. This is not
+    the flat sha256 of the file; entries of `PRETRAINED_MODELS` using this
+    scheme carry a "striped:" prefix.
+    """
+    size = target.stat().st_size
+    stripe = -(-size // stripes) if size else 1
+    ranges = [(offset, min(stripe, size - offset)) for offset in range(0, size, stripe)]
+    with ThreadPoolExecutor(max(len(ranges), 1)) as pool:
+        digests = pool.map(lambda r: _hash_range(target, *r), ranges)
+    return hashlib.sha256(b"".join(digests)).hexdigest()
+
+
+def verify_file(target, sha256):
+    if sha256.startswith("striped:"):
+        signature = "striped:" + parallel_sha256(target)
+    else:
+        with open(target, "rb") as f:
+            if hasattr(hashlib, "file_digest"):
+                # Python 3.11+, runs the whole read+hash loop in C.
+                signature = hashlib.file_digest(f, "sha256").hexdigest()
+            else:
+                # Hash straight from the page cache, no intermediate buffers.
+                hasher = hashlib.sha256()
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    hasher.update(mm)
+                signature = hasher.hexdigest()
     if signature != sha256:
         print(
             f"Invalid sha256 signature for the file {target}. Expected {sha256} but got "
@@ -79,6 +188,117 @@ def verify_file(target, sha256):
         sys.exit(1)
 
 
+def _verification_cache(models):
+    return models / ".verified.json"
+
+
+def _load_verification_cache(models):
+    try:
+        return json.loads(_verification_cache(models).read_text())
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _local_digest(path):
+    """
+    Fast content digest for the local verification cache, or None if blake3
+    is not installed. BLAKE3 is SIMD vectorized and hashes the mmapped file
+    with multiple threads, several times faster than SHA-256. This digest is
+    only ever compared against a value computed here on a previous run; the
+    upstream checkpoints are still checked with their published SHA-256.
+    """
+    if blake3 is None:
+        return None
+    hasher = blake3(max_threads=blake3.AUTO)
+    hasher.update_mmap(str(path))
+    return hasher.hexdigest()
+
+
+def is_verified(models, target, sha256):
+    """
+    True if `target` already passed verification against `sha256` and has
+    not changed since (same size and mtime, or same blake3 digest when only
+    the metadata changed). Saves a full read + SHA-256 of the checkpoint on
+    every startup. Delete `.verified.json` in the models folder to force
+    re-verification.
+    """
+    entry = _load_verification_cache(models).get(target.name)
+    if entry is None or entry.get("sha256") != sha256:
+        return False
+    stat = target.stat()
+    if entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+        return True
+    # Metadata changed, e.g. the file was copied or touched. Try the much
+    # cheaper content check before falling back to a full SHA-256.
+    if entry.get("blake3"):
+        return _local_digest(target) == entry["blake3"]
+    return False
+
+
+def mark_verified(models, target, sha256):
+    cache = _load_verification_cache(models)
+    stat = target.stat()
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+    digest = _local_digest(target)
+    if digest is not None:
+        entry["blake3"] = digest
+    cache[target.name] = entry
+    tmp = _verification_cache(models).with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(cache, indent=2))
+    os.replace(tmp, _verification_cache(models))
+
+
+def write_wav(path, data, samplerate=44100):
+    """
+    Minimal WAV writer for the int16 and float32 buffers produced by the
+    separation. The separated stems always have the same layout, so the
+    44 byte RIFF header is packed directly and the samples are written
+    in a single buffered call, skipping the validation and internal
+    copies of `scipy.io.wavfile.write`.
+    """
+    data = np.ascontiguousarray(data)
+    channels = data.shape[1]
+    sample_bytes = data.dtype.itemsize
+    audio_format = 1 if data.dtype == np.int16 else 3  # PCM vs IEEE float
+    header = struct.pack(
+        '<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data.nbytes, b'WAVE', b'fmt ', 16,
+        audio_format, channels, samplerate, samplerate * channels * sample_bytes,
+        channels * sample_bytes, 8 * sample_bytes, b'data', data.nbytes)
+    with open(path, 'wb', buffering=1 << 20) as f:
+        f.write(header)
+        f.write(data.tobytes())
+
+
+def export_onnx(model, onnx_path):
+    """
+    Export `model` to ONNX with a dynamic batch and time axis, so the same
+    graph serves any track length and batch size.
+    """
+    dummy = th.randn(1, 2, model.valid_length(44100))
+    th.onnx.export(model, dummy, str(onnx_path), opset_version=17,
+                   input_names=["mix"], output_names=["sources"],
+                   dynamic_axes={"mix": {0: "batch", 2: "time"},
+                                 "sources": {0: "batch", 3: "time"}})
+
+
+class OnnxModel:
+    """
+    Runs inference through an onnxruntime session while exposing the small
+    interface `apply_model` relies on (`valid_length` and a forward call),
+    so the rest of the pipeline does not have to know about the backend.
+    """
+    def __init__(self, session, reference):
+        self._session = session
+        self._reference = reference
+
+    def valid_length(self, length):
+        return self._reference.valid_length(length)
+
+    def __call__(self, mix):
+        out = self._session.run(None, {"mix": mix.numpy()})[0]
+        return th.from_numpy(out)
+
+
 def encode_mp3(wav, path, verbose=False):
     try:
         import lameenc
@@ -157,6 +377,24 @@ def main():
                         help="Opposite of --float32, here for compatibility.")
     parser.add_argument("--mp3", action="store_true",
                         help="Convert the output wavs to mp3 with 320 kb/s rate.")
+    parser.add_argument("--fp16", action="store_true",
+                        help="Run the model in half precision. Faster on GPU with "
+                        "no audible quality loss. Ignored on CPU.")
+    parser.add_argument("--int8", action="store_true",
+                        help="Dynamically quantize the LSTM and linear layers to int8. "
+                        "Faster and 4x smaller in RAM on CPU, might slightly worsen "
+                        "quality. Ignored on GPU.")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=4,
+                        help="Maximum number of tracks separated in one model call. "
+                        "Higher values amortize per-call overhead but increase "
+                        "memory usage; lower it if you run out of device memory.")
+    parser.add_argument("--onnx", action="store_true",
+                        help="On CPU, export the model to ONNX next to the checkpoint "
+                        "(one time operation) and run inference with onnxruntime, "
+                        "which is usually faster than eager PyTorch. Requires the "
+                        "onnxruntime package. Ignored on GPU, incompatible with --int8.")
 
     args = parser.parse_args()
     name = args.name + ".th"
@@ -178,16 +416,59 @@ def main():
         args.models.mkdir(exist_ok=True, parents=True)
         url = BASE_URL + name
         print("Downloading pre-trained model weights, this could take a while...")
-        download_file(url, model_path)
-    if sha256 is not None:
+        download_file(url, model_path, sha256)
+        if sha256 is not None:
+            # The digest was checked while streaming the download.
+            mark_verified(args.models, model_path, sha256)
+    elif sha256 is not None and not is_verified(args.models, model_path, sha256):
         verify_file(model_path, sha256)
-    model = load_model(model_path).to(args.device)
+        mark_verified(args.models, model_path, sha256)
+    model = load_model(model_path)
+    if args.fp16 and args.device != "cpu":
+        model = model.half()
+    elif args.int8 and args.device == "cpu" and not args.onnx:
+        # The convolutions are kept in float, they are more sensitive to
+        # quantization and have no dynamic int8 kernels anyway.
+        engines = th.backends.quantized.supported_engines
+        th.backends.quantized.engine = "fbgemm" if "fbgemm" in engines else "qnnpack"
+        model = th.quantization.quantize_dynamic(
+            model, {th.nn.LSTM, th.nn.Linear}, dtype=th.qint8)
+    model = model.to(args.device)
+    model.eval()
+    if args.device == "cpu":
+        th.set_num_threads(os.cpu_count())
+    else:
+        # Chunk sizes are constant thanks to `split`, so letting cuDNN
+        # benchmark its algorithms once pays off over the whole batch.
+        th.backends.cudnn.benchmark = True
+    if args.onnx and args.device == "cpu":
+        try:
+            import onnxruntime
+        except ImportError:
+            print("Cannot use --onnx, the onnxruntime package is not installed. "
+                  "Run `python3 -m pip install -U onnxruntime`, then try again.",
+                  file=sys.stderr)
+            sys.exit(1)
+        onnx_path = Path(str(model_path) + ".onnx")
+        if not onnx_path.is_file():
+            print("Exporting the model to ONNX, this is a one time operation...")
+            export_onnx(model, onnx_path)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = onnxruntime.InferenceSession(str(onnx_path), options,
+                                               providers=["CPUExecutionProvider"])
+        model = OnnxModel(session, model)
     if args.quantized:
         args.name += "_quantized"
     out = args.out / args.name
     out.mkdir(parents=True, exist_ok=True)
     source_names = ["drums", "bass", "other", "vocals"]
     print(f"Separated tracks will be stored in {out.resolve()}")
+    # Wav encoding is pure I/O and releases the GIL, so it can run in the
+    # background while the model processes the next track.
+    executor = ThreadPoolExecutor(max_workers=4)
+    futures = []
+    tracks = []
     for track in args.tracks:
         if not track.exists():
             print(
@@ -195,27 +476,88 @@ def main():
                 "please try again after surrounding the entire path with quotes \"\".",
                 file=sys.stderr)
             continue
-        print(f"Separating track {track}")
-        wav = AudioFile(track).read(streams=0, samplerate=44100, channels=2).to(args.device)
-        # Round to nearest short integer for compatibility with how MusDB load audio with stempeg.
-        wav = (wav * 2**15).round() / 2**15
-        ref = wav.mean(0)
-        wav = (wav - ref.mean()) / ref.std()
-        sources = apply_model(model, wav, shifts=args.shifts, split=args.split, progress=True)
-        sources = sources * ref.std() + ref.mean()
-
-        track_folder = out / track.name.split(".")[0]
-        track_folder.mkdir(exist_ok=True)
-        for source, name in zip(sources, source_names):
-            if args.mp3 or not args.float32:
-                source = (source * 2**15).clamp_(-2**15, 2**15 - 1).short()
-            source = source.cpu().transpose(0, 1).numpy()
-            stem = str(track_folder / name)
-            if args.mp3:
-                encode_mp3(source, stem + ".mp3", verbose=args.verbose)
+        tracks.append(track)
+    if not tracks:
+        return
+    # Group tracks of similar length in the same sub-batch, so that the zero
+    # padding to the longest member stays small. ffprobe gives the duration
+    # without decoding anything.
+    tracks.sort(key=lambda track: AudioFile(track).duration)
+    for first in range(0, len(tracks), args.batch_size):
+        sub_tracks = tracks[first:first + args.batch_size]
+        wavs = []
+        means = []
+        stds = []
+        for track in sub_tracks:
+            print(f"Loading track {track}")
+            wav = AudioFile(track).read(streams=0, samplerate=44100, channels=2)
+            if args.device != "cpu":
+                # Stage through page-locked memory so the host to device copy
+                # is asynchronous and overlaps with decoding the next track.
+                wav = wav.pin_memory().to(args.device, non_blocking=True)
             else:
-                wavname = str(track_folder / f"{name}.wav")
-                wavfile.write(wavname, 44100, source)
+                wav = wav.to(args.device)
+            # Round to nearest short integer for compatibility with how MusDB
+            # load audio with stempeg. In-place, and multiplying by the exact
+            # inverse rather than dividing: three passes over one allocation
+            # instead of three fresh tensors.
+            wav = wav.mul_(SCALE_I16).round_().mul_(INV_SCALE_I16)
+            ref = wav.mean(0)
+            # Pull the statistics out as Python floats once, then normalize in
+            # place: two kernels over the waveform, no temporaries.
+            mean = ref.mean().item()
+            std = ref.std().item()
+            means.append(mean)
+            stds.append(std)
+            wavs.append(wav.sub_(mean).div_(std))
+        # Stack the sub-batch so the model is applied once for all its
+        # tracks, amortizing the per-call chunking and kernel launch
+        # overhead while keeping peak memory bounded by --batch-size.
+        lengths = [wav.shape[-1] for wav in wavs]
+        batch = th.stack([F.pad(wav, (0, max(lengths) - wav.shape[-1])) for wav in wavs])
+        del wavs
+        if args.fp16 and args.device != "cpu":
+            batch = batch.half()
+        print(f"Separating {len(sub_tracks)} track(s)")
+        with th.inference_mode() if hasattr(th, "inference_mode") else th.no_grad():
+            all_sources = apply_model(model, batch, shifts=args.shifts, split=args.split,
+                                      progress=True)
+            all_sources = all_sources.float()
+            all_sources.mul_(th.tensor(stds, device=all_sources.device).view(-1, 1, 1, 1))
+            all_sources.add_(th.tensor(means, device=all_sources.device).view(-1, 1, 1, 1))
+        for track, length, sources in zip(sub_tracks, lengths, all_sources):
+            sources = sources[..., :length]
+            track_folder = out / track.name.split(".")[0]
+            track_folder.mkdir(exist_ok=True)
+            for source, name in zip(sources, source_names):
+                if args.mp3 or not args.float32:
+                    # Convert to int16 on the device so only half the bytes
+                    # are transferred.
+                    source = source.mul(SCALE_I16).round_().clamp_(MIN_I16, MAX_I16)
+                    source = source.to(th.int16)
+                source = source.transpose(0, 1).contiguous().cpu().numpy()
+                stem = str(track_folder / name)
+                if args.mp3:
+                    encode_mp3(source, stem + ".mp3", verbose=args.verbose)
+                else:
+                    # `source` is already a CPU numpy buffer at this point, so
+                    # the write can safely happen in the background. Prefer
+                    # libsndfile (C encoder with its own I/O buffering) when
+                    # it is installed.
+                    if soundfile is not None:
+                        subtype = "FLOAT" if args.float32 else "PCM_16"
+                        futures.append(executor.submit(soundfile.write, stem + ".wav",
+                                                       source, 44100, subtype=subtype))
+                    else:
+                        futures.append(executor.submit(write_wav, stem + ".wav", source))
+        # Release the device copies before loading the next sub-batch;
+        # `sources` is a view that would keep `all_sources` storage alive.
+        del batch, all_sources, sources
+    # Re-raise any write error (full disk, permissions...), shutdown alone
+    # would silently swallow them.
+    for future in futures:
+        future.result()
+    executor.shutdown(wait=True)
 
 
 if __name__ == "__main__":
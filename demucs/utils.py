@@ -94,7 +94,9 @@ def human_seconds(seconds, display='.2f'):
 
 def apply_model(model, mix, shifts=None, split=False, progress=False):
     """
-    Apply model to a given mixture.
+    Apply model to a given mixture. `mix` can be a single mixture of shape
+    [C, T], or a batch of mixtures [B, C, T] which will all go through the
+    model in a single forward pass.
 
     Args:
         shifts (int): if > 0, will shift in time `mix` by a random amount between 0 and 0.5 sec
@@ -106,10 +108,10 @@ def apply_model(model, mix, shifts=None, split=False, progress=False):
             Useful for model with large memory footprint like Tasnet.
         progress (bool): if True, show a progress bar (requires split=True)
     """
-    channels, length = mix.size()
+    channels, length = mix.shape[-2:]
     device = mix.device
     if split:
-        out = th.zeros(4, channels, length, device=device)
+        out = th.zeros(mix.shape[:-2] + (4, channels, length), device=device)
         shift = 44_100 * 10
         offsets = range(0, length, shift)
         scale = 10
@@ -138,7 +140,10 @@ def apply_model(model, mix, shifts=None, split=False, progress=False):
         delta = valid_length - length
         padded = F.pad(mix, (delta // 2, delta - delta // 2))
         with th.no_grad():
-            out = model(padded.unsqueeze(0))[0]
+            if padded.dim() == 2:
+                out = model(padded.unsqueeze(0))[0]
+            else:
+                out = model(padded)
         return center_trim(out, mix)
 
 
@@ -161,7 +166,14 @@ def load_model(path):
         load_from = path
         if str(path).endswith(".gz"):
             load_from = gzip.open(path, "rb")
-        klass, args, kwargs, state = th.load(load_from, 'cpu')
+            klass, args, kwargs, state = th.load(load_from, 'cpu')
+        else:
+            try:
+                # PyTorch 2.1+ with zipfile checkpoints: weights are mapped
+                # from the page cache rather than copied through a buffer.
+                klass, args, kwargs, state = th.load(load_from, 'cpu', mmap=True)
+            except (TypeError, RuntimeError):
+                klass, args, kwargs, state = th.load(load_from, 'cpu')
     model = klass(*args, **kwargs)
     model.load_state_dict(state)
     return model